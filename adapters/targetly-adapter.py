@@ -1,12 +1,19 @@
 import os
+import re
 import sys
 import json
 import asyncio
-import subprocess
+import logging
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from json.decoder import scanstring
 from uuid import uuid4
+import anyio.to_thread
 import uvicorn
 from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import DEFAULT_EXCLUDED_CONTENT_TYPES, GZipMiddleware
 from sse_starlette.sse import EventSourceResponse
 
 """
@@ -24,21 +31,51 @@ Key protocol details (from MCP SDK):
 # Configuration
 PORT = int(os.environ.get("PORT", 8080))
 DEBUG = os.environ.get("TARGETLY_DEBUG", "").lower() in ("true", "1", "yes")
+# Worker threads for blocking work (asyncio default executor and Starlette's sync handlers)
+THREADS = int(os.environ.get("TARGETLY_THREADS", 64))
+
+# Adapter logger; configured on its own so DEBUG doesn't turn on library logs
+log = logging.getLogger("targetly")
+_handler = logging.StreamHandler(sys.stdout)
+_handler.setFormatter(logging.Formatter("Targetly Adapter: %(message)s"))
+log.addHandler(_handler)
+log.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+log.propagate = False
+# Checked once so hot paths can skip building debug-only arguments
+_DBG = log.isEnabledFor(logging.DEBUG)
+# Max size of a single JSON-RPC line read from the child's stdout
+# (well above MAX_BODY_SIZE, since results are usually larger than requests)
+STDOUT_LIMIT = 16 << 20
+# Max messages buffered per SSE session before the oldest are dropped
+SESSION_QUEUE_SIZE = 1024
+# Max size of a POSTed JSON-RPC message
+MAX_BODY_SIZE = 4 << 20
+# Max messages waiting to be written to the child's stdin
+STDIN_QUEUE_SIZE = 4096
 
 # --- Command Detection ---
-def get_server_command():
+def get_server_command(use_baked=True):
     """Detect the MCP server command to run."""
     # 1. Explicit full command override
-    if os.environ.get("TARGETLY_MCP_CMD"):
+    cmd_override = os.environ.get("TARGETLY_MCP_CMD")
+    if cmd_override:
         import shlex
-        return shlex.split(os.environ.get("TARGETLY_MCP_CMD"))
+        return shlex.split(cmd_override)
     
     # 2. Script-based execution
     server_script = os.environ.get("TARGETLY_MCP_SERVER_SCRIPT") or (sys.argv[1] if len(sys.argv) > 1 else None)
     if server_script and os.path.exists(server_script):
         return ["python", server_script]
     
-    # 3. Detect from pyproject.toml
+    # 3. Command frozen at image build time by --bake-cmd
+    if use_baked:
+        try:
+            from targetly_cmd import CMD as baked_cmd
+            return baked_cmd
+        except ImportError:
+            pass
+    
+    # 4. Detect from pyproject.toml
     if os.path.exists("pyproject.toml"):
         try:
             import tomllib
@@ -50,21 +87,35 @@ def get_server_command():
         except Exception:
             pass
     
-    # 4. Fallback
+    # 5. Fallback
     return ["python", "main.py"]
 
+def bake_server_command():
+    """Write the detected command to targetly_cmd.py next to this script."""
+    cmd = get_server_command(use_baked=False)
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "targetly_cmd.py")
+    with open(path, "w") as f:
+        f.write(f"CMD = {cmd!r}\n")
+    return cmd
+
+# `python targetly-adapter.py --bake-cmd` (run from the server's WORKDIR at
+# build time) skips detection on every later start
+if sys.argv[1:2] == ["--bake-cmd"]:
+    del sys.argv[1]
+    log.info("Baked server command: %s", bake_server_command())
+    sys.exit(0)
+
 CMD = get_server_command()
-print(f"Targetly Adapter: Starting server with command: {CMD}")
-
-# Spawn the child process
-process = subprocess.Popen(
-    CMD,
-    stdin=subprocess.PIPE,
-    stdout=subprocess.PIPE,
-    stderr=sys.stderr,
-    text=True,
-    bufsize=1
-)
+log.info("Starting server with command: %s", CMD)
+
+# Child process, spawned on startup (needs a running event loop)
+process = None
+# Non-blocking write end of the child's stdin pipe
+stdin_fd = None
+# Outgoing lines for the child, written by stdin_writer
+stdin_queue = asyncio.Queue(maxsize=STDIN_QUEUE_SIZE)
+# Cleared when stdin_writer stops (e.g. the child exited); POSTs then fail fast
+stdin_alive = True
 
 # --- FastAPI App ---
 app = FastAPI()
@@ -77,44 +128,135 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Session management: map session_id -> response queue
+# Compress the SSE stream too: Starlette excludes it by default, but it
+# sync-flushes every chunk, so each event still reaches the client at once.
+app.add_middleware(
+    GZipMiddleware,
+    minimum_size=512,
+    exclude_content_types=tuple(t for t in DEFAULT_EXCLUDED_CONTENT_TYPES if t != "text/event-stream"),
+)
+
+class SessionBuf:
+    """Outgoing messages for one SSE session.
+
+    stdout_reader is the only producer and the session's event_generator the
+    only consumer, so a bounded deque plus an Event is all the sync needed.
+    `pending` maps this session's in-flight request ids to their adapter ids.
+    `lagging` is set while the buffer is overflowing, so drops are logged once.
+    """
+    __slots__ = ("buf", "ev", "pending", "lagging")
+
+    def __init__(self):
+        self.buf = collections.deque(maxlen=SESSION_QUEUE_SIZE)
+        self.ev = asyncio.Event()
+        self.pending = {}
+        self.lagging = False
+
+# Session management: map session_id -> SessionBuf
 sessions = {}
 
+# In-flight client requests: adapter-assigned id -> (session_id, original id,
+# original id exactly as the client wrote it)
+pending_ids = {}
+_next_id = itertools.count()
+
+_decoder = json.JSONDecoder()
+_WS = re.compile(r"[ \t\n\r]*")
+
+def parse_object(text):
+    """Parse the top level of a JSON object without re-encoding anything.
+
+    Returns {key: (value, start, end)}, where text[start:end] is the value's
+    source, so a single value (the id) can be replaced while every other byte
+    of the message is forwarded untouched. Raises ValueError if text is not
+    exactly one JSON object.
+    """
+    fields = {}
+    idx = _WS.match(text).end()
+    if text[idx:idx + 1] != "{":
+        raise ValueError("Expecting '{'")
+    idx = _WS.match(text, idx + 1).end()
+    if text[idx:idx + 1] == "}":
+        idx += 1
+    else:
+        while True:
+            if text[idx:idx + 1] != '"':
+                raise ValueError("Expecting property name")
+            key, idx = scanstring(text, idx + 1)
+            idx = _WS.match(text, idx).end()
+            if text[idx:idx + 1] != ":":
+                raise ValueError("Expecting ':'")
+            start = _WS.match(text, idx + 1).end()
+            try:
+                value, idx = _decoder.scan_once(text, start)
+            except StopIteration:
+                raise ValueError("Expecting value") from None
+            fields[key] = (value, start, idx)
+            idx = _WS.match(text, idx).end()
+            delimiter = text[idx:idx + 1]
+            idx += 1
+            if delimiter == "}":
+                break
+            if delimiter != ",":
+                raise ValueError("Expecting ',' or '}'")
+            idx = _WS.match(text, idx).end()
+    if _WS.match(text, idx).end() != len(text):
+        raise ValueError("Extra data")
+    return fields
+
+def splice(text, start, end, value):
+    """Replace text[start:end] with value and encode the result."""
+    return (text[:start] + value + text[end:]).encode(errors="surrogateescape")
+
+# Pre-encoded SSE framing (EventSourceResponse passes bytes through untouched).
+# JSON-RPC lines never contain newlines, so each one fits in a single data field.
+_MESSAGE_PREFIX = b"event: message\r\ndata: "
+_FRAME_END = b"\r\n\r\n"
+_PING_FRAME = b": ping" + _FRAME_END
+
 @app.get("/sse")
 async def sse(request: Request):
     """SSE Endpoint for MCP Clients."""
-    session_id = uuid4()
-    response_queue = asyncio.Queue()
-    sessions[session_id.hex] = response_queue
+    session_id = uuid4().hex
+    session = SessionBuf()
+    sessions[session_id] = session
     
-    if DEBUG:
-        print(f"Targetly Adapter: New SSE session: {session_id.hex}")
+    log.debug("New SSE session: %s", session_id)
     
     async def event_generator():
         # First event: tell client where to POST
-        yield {"event": "endpoint", "data": f"/messages?session_id={session_id.hex}"}
-        if DEBUG:
-            print(f"Targetly Adapter: Sent endpoint event for session {session_id.hex}")
+        yield b"event: endpoint\r\ndata: /messages?session_id=" + session_id.encode() + _FRAME_END
+        log.debug("Sent endpoint event for session %s", session_id)
         
         try:
+            # No is_disconnected() polling here: EventSourceResponse listens for
+            # the disconnect itself and cancels this generator, running the cleanup.
             while True:
-                if await request.is_disconnected():
-                    break
+                if not session.buf:
+                    try:
+                        # Wait for messages with timeout for keep-alive
+                        await asyncio.wait_for(session.ev.wait(), timeout=15.0)
+                    except asyncio.TimeoutError:
+                        # Send ping to keep connection alive
+                        yield _PING_FRAME
+                        continue
+                    session.ev.clear()
                 
-                try:
-                    # Wait for message from queue with timeout for keep-alive
-                    message = await asyncio.wait_for(response_queue.get(), timeout=15.0)
-                    yield {"event": "message", "data": message}
-                    if DEBUG:
-                        print(f"Targetly Adapter: OUTGOING: {message}")
-                except asyncio.TimeoutError:
-                    # Send ping to keep connection alive
-                    yield {"comment": "ping"}
+                # Drain the whole burst in one wake-up
+                while session.buf:
+                    message = session.buf.popleft()
+                    yield _MESSAGE_PREFIX + message + _FRAME_END
+                    if _DBG:
+                        log.debug("OUTGOING: %s", message.decode(errors="replace"))
+                # Caught up; warn again if the client falls behind later
+                session.lagging = False
         finally:
-            # Cleanup session
-            sessions.pop(session_id.hex, None)
-            if DEBUG:
-                print(f"Targetly Adapter: Session {session_id.hex} closed")
+            # Cleanup session and forget requests whose responses can no
+            # longer be delivered (no awaits here, so nothing can race this)
+            sessions.pop(session_id, None)
+            for adapter_id in session.pending.values():
+                pending_ids.pop(adapter_id, None)
+            log.debug("Session %s closed", session_id)
     
     return EventSourceResponse(event_generator())
 
@@ -124,56 +266,220 @@ async def handle_message(request: Request):
     session_id = request.query_params.get("session_id")
     
     if not session_id or session_id not in sessions:
-        if DEBUG:
-            print(f"Targetly Adapter: Invalid session_id: {session_id}")
+        log.debug("Invalid session_id: %s", session_id)
+        return Response("Invalid or missing session_id", status_code=400)
+    
+    if not stdin_alive or process.returncode is not None:
+        return Response("MCP server is not running", status_code=503)
+    
+    # Read the body incrementally so oversized messages are rejected early
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > MAX_BODY_SIZE:
+            return Response("Message too large", status_code=413)
+        chunks.append(chunk)
+    body = b"".join(chunks)
+    
+    session = sessions.get(session_id)
+    if session is None:
+        # The SSE stream closed while the body was being read
         return Response("Invalid or missing session_id", status_code=400)
     
-    body = await request.body()
-    json_line = body.decode() + "\n"
+    # surrogateescape keeps any invalid UTF-8 byte-exact through the splice
+    text = body.decode(errors="surrogateescape")
+    try:
+        fields = parse_object(text)
+    except ValueError:
+        fields = {}
+    method = fields.get("method", (None,))[0]
     
-    if DEBUG:
-        print(f"Targetly Adapter: INCOMING: {body.decode()}")
+    if "method" in fields and isinstance(fields.get("id", (None,))[0], (str, int)):
+        # Every client numbers its requests from 0, so ids collide across
+        # sessions. Give the child a unique id and restore the original one
+        # when the response comes back.
+        request_id, start, end = fields["id"]
+        adapter_id = next(_next_id)
+        session.pending[request_id] = adapter_id
+        pending_ids[adapter_id] = (session_id, request_id, text[start:end])
+        json_line = splice(text, start, end, str(adapter_id)) + b"\n"
+    elif method == "notifications/cancelled":
+        # The child only knows adapter ids, so the cancelled id must be mapped too
+        params, params_start, params_end = fields.get("params", (None, 0, 0))
+        request_id = params.get("requestId") if isinstance(params, dict) else None
+        adapter_id = session.pending.get(request_id) if isinstance(request_id, (str, int)) else None
+        if adapter_id is None:
+            log.debug("Dropped cancel for unknown request %s", request_id)
+            return Response("Accepted", status_code=202)
+        _, start, end = parse_object(text[params_start:params_end])["requestId"]
+        json_line = splice(text, params_start + start, params_start + end, str(adapter_id)) + b"\n"
+    else:
+        json_line = body + b"\n"
     
-    # Write to process stdin
-    process.stdin.write(json_line)
-    process.stdin.flush()
+    if _DBG:
+        log.debug("INCOMING: %s", body.decode(errors="replace"))
+    
+    # Hand off to stdin_writer so a slow child never stalls this handler
+    await stdin_queue.put(json_line)
+    if not stdin_alive:
+        # The writer died while this message was waiting for queue space
+        return Response("MCP server is not running", status_code=503)
     
     return Response("Accepted", status_code=202)
 
+def enqueue(session_id, session, message):
+    """Buffer a message for a session; the deque drops its oldest ones if the client is lagging."""
+    if len(session.buf) == SESSION_QUEUE_SIZE and not session.lagging:
+        session.lagging = True
+        log.warning("Session %s is lagging, dropping oldest messages", session_id)
+    session.buf.append(message)
+    session.ev.set()
+
+def preview(data, limit=200):
+    """Decode at most `limit` bytes of data for a log line."""
+    text = data[:limit].decode(errors="replace")
+    return text + "..." if len(data) > limit else text
+
+async def skip_line(stream):
+    """Discard the rest of an over-long line, up to and including its newline."""
+    while True:
+        try:
+            await stream.readuntil(b"\n")
+            return
+        except asyncio.LimitOverrunError as e:
+            await stream.readexactly(e.consumed)
+        except asyncio.IncompleteReadError:
+            return
+
 # Background task to read stdout and dispatch to sessions
 async def stdout_reader():
     """Read from child process stdout and dispatch to active sessions."""
-    loop = asyncio.get_event_loop()
-    
     while True:
         try:
-            line = await loop.run_in_executor(None, process.stdout.readline)
+            try:
+                line = await process.stdout.readuntil(b"\n")
+            except asyncio.IncompleteReadError as e:
+                # EOF; still deliver a final unterminated line
+                line = e.partial
+            except asyncio.LimitOverrunError:
+                await skip_line(process.stdout)
+                log.warning("Dropped line over %d bytes from process", STDOUT_LIMIT)
+                continue
             if not line:
-                print("Targetly Adapter: Child process stdout closed")
+                log.info("Child process stdout closed")
                 break
             
             line = line.strip()
             if not line:
                 continue
             
-            try:
-                # Validate JSON
-                json.loads(line)
-                
-                # Dispatch to ALL active sessions (MCP doesn't use session-specific routing for responses)
-                for session_id, queue in list(sessions.items()):
-                    await queue.put(line)
-                    if DEBUG:
-                        print(f"Targetly Adapter: Dispatched to session {session_id}")
-            except json.JSONDecodeError:
-                print(f"Targetly Adapter: Ignored non-JSON from process: {line}")
+            # Cheap structural check; a full parse is only needed for routing
+            if line[:1] not in (b"{", b"[") or line[-1:] not in (b"}", b"]"):
+                log.warning("Ignored non-JSON from process: %s", preview(line))
+                continue
+            
+            fields = {}
+            if _DBG or b'"id"' in line:
+                text = line.decode(errors="surrogateescape")
+                try:
+                    if line[:1] == b"{":
+                        fields = parse_object(text)
+                    else:
+                        json.loads(text)
+                except ValueError:
+                    log.warning("Ignored non-JSON from process: %s", preview(line))
+                    continue
+            
+            # Responses go back to the session that sent the request
+            if "method" not in fields and type(fields.get("id", (None,))[0]) is int:
+                adapter_id, start, end = fields["id"]
+                pending = pending_ids.pop(adapter_id, None)
+                if pending is None:
+                    # Its session has closed; the adapter id means nothing to
+                    # any other client, so never broadcast it
+                    log.debug("Dropped response for closed request %s", adapter_id)
+                    continue
+                session_id, request_id, raw_id = pending
+                session = sessions.get(session_id)
+                if session is not None:
+                    # Leave the entry alone if the client already reused the id
+                    if session.pending.get(request_id) == adapter_id:
+                        del session.pending[request_id]
+                    enqueue(session_id, session, splice(text, start, end, raw_id))
+                    log.debug("Dispatched to session %s", session_id)
+                continue
+            
+            # Notifications and server requests go to ALL active sessions
+            # enqueue never awaits, so sessions cannot change mid-iteration
+            for session_id, session in sessions.items():
+                enqueue(session_id, session, line)
+            log.debug("Dispatched to %d sessions", len(sessions))
         except Exception as e:
-            print(f"Targetly Adapter: stdout_reader error: {e}")
+            log.error("stdout_reader error: %s", e)
             break
 
+async def wait_writable(fd):
+    """Wait until fd can accept more data."""
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_writer(fd, ready.set_result, None)
+    try:
+        await ready
+    finally:
+        loop.remove_writer(fd)
+
+# Background task to write queued messages to stdin
+async def stdin_writer():
+    """Write queued messages to the child process stdin in order."""
+    while True:
+        try:
+            json_line = await stdin_queue.get()
+            # Typical frames go out in a single os.write(); larger ones, or a
+            # full pipe, wait for the fd to become writable.
+            view = memoryview(json_line)
+            while view:
+                try:
+                    view = view[os.write(stdin_fd, view):]
+                except BlockingIOError:
+                    await wait_writable(stdin_fd)
+        except Exception as e:
+            log.error("stdin_writer error: %s", e)
+            break
+    
+    global stdin_alive
+    stdin_alive = False
+    # Release handlers blocked on a full queue; they report 503 themselves
+    while not stdin_queue.empty():
+        stdin_queue.get_nowait()
+
 @app.on_event("startup")
 async def startup_event():
+    global process, stdin_fd
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREADS))
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADS
+    
+    # Own the stdin pipe so writes can go straight to the fd
+    stdin_rfd, stdin_fd = os.pipe()
+    os.set_blocking(stdin_fd, False)
+    process = await asyncio.create_subprocess_exec(
+        *CMD,
+        stdin=stdin_rfd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=sys.stderr,
+        limit=STDOUT_LIMIT,
+    )
+    os.close(stdin_rfd)
     asyncio.create_task(stdout_reader())
+    asyncio.create_task(stdin_writer())
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    # uvloop + httptools ship with fastapi[standard] (uvicorn[standard])
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=PORT,
+        loop="uvloop",
+        http="httptools",
+        log_level="debug" if DEBUG else "warning",
+    )